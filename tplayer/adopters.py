@@ -1,3 +1,4 @@
+import re
 import time
 from json import dump as dump_json
 from json import load as load_json
@@ -71,21 +72,23 @@ class TerminalAdopter(object):
 
 
 class HyperAdopter(TerminalAdopter):
+    _FONT_RE = re.compile(r"fontSize:\s*\d+")
+
     def __init__(self) -> None:
         """Adopter for the web-based terminal Hyper."""
         super().__init__()
         self.CONFIG_FILE_LOC = f"{str(Path.home())}/.hyper.js"
 
         self.config: str = self.load_config()
-        self.backup_config: str = self.load_config()
+        # strings are immutable, so the backup can share the loaded config
+        self.backup_config: str = self.config
 
     def adjust_terminal_font_size(self, font_size: int) -> None:
-        current_font_size: int = int(self.config[self.config.find(
-            "fontSize"):].split(":", 1)[-1].split(",", 1)[0].strip())
-        if current_font_size == font_size:
+        config: str = self._FONT_RE.sub(
+            f"fontSize: {font_size}", self.config, count=1)
+        if config == self.config:
             return
-        self.config = self.config.replace(
-            f"fontSize: {current_font_size}", f"fontSize: {font_size}")
+        self.config = config
         self.save_config(self.config)
 
     def restore_terminal_font_size(self) -> None:
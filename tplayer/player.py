@@ -1,21 +1,173 @@
-import json
+import mmap
 import os
-import pickle
-from hashlib import md5
+import subprocess
+import sys
+from collections import deque
+from collections.abc import Iterable, Iterator
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from hashlib import blake2b
+from multiprocessing import get_context
 from os import get_terminal_size
-from time import sleep, time
+from pathlib import Path
+from queue import Queue
+from threading import Thread
+from time import perf_counter_ns, sleep
 from uuid import uuid4
 
+import av
 import cv2
-import moviepy.editor as mp
-from climage import convert as convert_image
-from playsound import playsound
-from rich.console import Console
+import imageio_ffmpeg
+import numpy as np
+import orjson
+import simpleaudio
 from rich.progress import Progress
-from rich.text import Text
 
 from adopters import HyperAdopter, TerminalAdopter
 
+# Bump whenever the on-disk cache layout changes, older entries are ignored
+CACHE_VERSION = 6
+# Only decode keyframes once output frames are at least this many source frames apart,
+# about the keyframe interval of common encodes
+KEYFRAME_MIN_STEP = 60
+
+
+# SGR fragments for every channel value, a truecolor half-block cell is
+# `BG_RED[r1] GREEN[g1] BLUE[b1] FG_RED[r2] GREEN[g2] HALF_BLOCK_BLUE[b2]`
+_SGR_BG_RED = np.array([f"\x1b[48;2;{i};" for i in range(256)], dtype=object)
+_SGR_FG_RED = np.array([f"\x1b[38;2;{i};" for i in range(256)], dtype=object)
+_SGR_GREEN = np.array([f"{i};" for i in range(256)], dtype=object)
+_SGR_BLUE = np.array([f"{i}m" for i in range(256)], dtype=object)
+_SGR_HALF_BLOCK_BLUE = np.array([f"{i}m▄" for i in range(256)], dtype=object)
+
+
+def _downscale(frame: np.ndarray, width: int, height: int) -> np.ndarray:
+    """Resize a frame to the pixel size of its ANSI rendering.
+
+    Frames taller than the terminal are cropped to their middle, since frames are written
+    to the screen as-is and anything taller would scroll it.
+
+    Args:
+        frame (np.ndarray): BGR frame as decoded by OpenCV.
+        width (int): Output width in terminal columns.
+        height (int): Output height limit in terminal rows.
+
+    Returns:
+        np.ndarray: Frame `width` pixels wide, with two pixel rows per terminal row.
+    """
+    rows = int(frame.shape[0] * width / frame.shape[1] / 2)
+    image = cv2.resize(frame, (width, rows * 2), interpolation=cv2.INTER_AREA)
+    top = max(rows - height, 0) // 2
+    return image[top * 2:(top + min(rows, height)) * 2]
+
+
+def _frame_to_ansi(frame: np.ndarray) -> str:
+    """Convert a downscaled frame to ANSI strings.
+
+    Every character is a lower half block, the background colors the upper pixel and
+    the foreground colors the lower one. Kept at module scope so it can be pickled into
+    worker processes.
+
+    Args:
+        frame (np.ndarray): BGR frame as returned by `_downscale()` .
+
+    Returns:
+        str: ANSI string of the given frame.
+    """
+    rgb = frame[..., ::-1]
+    upper, lower = rgb[0::2], rgb[1::2]
+    cells = np.empty((upper.shape[0], upper.shape[1] * 6 + 1), dtype=object)
+    cells[:, 0:-1:6] = _SGR_BG_RED[upper[..., 0]]
+    cells[:, 1:-1:6] = _SGR_GREEN[upper[..., 1]]
+    cells[:, 2:-1:6] = _SGR_BLUE[upper[..., 2]]
+    cells[:, 3:-1:6] = _SGR_FG_RED[lower[..., 0]]
+    cells[:, 4:-1:6] = _SGR_GREEN[lower[..., 1]]
+    cells[:, 5:-1:6] = _SGR_HALF_BLOCK_BLUE[lower[..., 2]]
+    cells[:, -1] = "\x1b[0m\n"
+    # a newline after the last row would scroll a frame as tall as the screen
+    cells[-1, -1] = "\x1b[0m"
+    return "".join(cells.ravel().tolist())
+
+
+def _dump_frames(path: str, frames: Iterable[str], indices: list[int]) -> None:
+    """Write frames to `path` as length-prefixed records.
+
+    The first record holds `indices` as little-endian uint32s, each following record
+    is a unique frame encoded as UTF-8.
+
+    Args:
+        path (str): Output file path.
+        frames (Iterable[str]): Unique ANSI frames to write.
+        indices (list[int]): Index into `frames` of every frame in playback order.
+    """
+    with open(path, "wb") as f:
+        data = np.asarray(indices, dtype="<u4").tobytes()
+        f.write(len(data).to_bytes(4, "little"))
+        f.write(data)
+        for frame in frames:
+            data = frame.encode()
+            f.write(len(data).to_bytes(4, "little"))
+            f.write(data)
+
+
+def _load_frames(path: str) -> Iterator[bytes]:
+    """Map a frame file written by `_dump_frames()` and index its records.
+
+    The file is opened and checked right away, frames are only sliced out of it as the
+    returned iterator is consumed.
+
+    Args:
+        path (str): Frame file path.
+
+    Raises:
+        ValueError: Frame file is empty or corrupt.
+
+    Returns:
+        Iterator[bytes]: UTF-8 encoded ANSI frames in playback order.
+    """
+    with open(path, "rb") as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    records = []
+    pos = 0
+    while pos + 4 <= len(mm):
+        size = int.from_bytes(mm[pos:pos + 4], "little")
+        records.append((pos + 4, pos + 4 + size))
+        pos += 4 + size
+    if pos != len(mm) or (records[0][1] - records[0][0]) % 4:
+        mm.close()
+        raise ValueError(f"Corrupt frame file {path}")
+    start, end = records[0]
+    indices = np.frombuffer(mm[start:end], dtype="<u4").tolist()
+    if max(indices, default=-1) >= len(records) - 1:
+        mm.close()
+        raise ValueError(f"Corrupt frame file {path}")
+    return _iter_frames(mm, records[1:], indices)
+
+
+def _iter_frames(mm: mmap.mmap, records: list[tuple[int, int]], indices: list[int]) -> Iterator[bytes]:
+    """Lazily slice frames out of a frame file mapped by `_load_frames()` .
+
+    Consecutive repeats of a frame yield the very same object. `mm` is closed once
+    the iteration ends.
+
+    Args:
+        mm (mmap.mmap): The mapped frame file.
+        records (list[tuple[int, int]]): Start and end offsets of every unique frame.
+        indices (list[int]): Index into `records` of every frame in playback order.
+
+    Yields:
+        bytes: UTF-8 encoded ANSI frames in playback order.
+    """
+    try:
+        last, frame = None, None
+        for index in indices:
+            if index != last:
+                start, end = records[index]
+                frame = mm[start:end]
+                last = index
+            yield frame
+    finally:
+        mm.close()
+
 
 class Player(object):
     def __init__(self, video_path: str) -> None:
@@ -26,134 +178,223 @@ class Player(object):
         """
         super().__init__()
         self.adopter: TerminalAdopter = None
-        self.video = cv2.VideoCapture(video_path)
+        self.video = av.open(video_path)
         self.video_path = video_path
         self.video_name = video_path.split("/")[-1].split(".", 1)[0]
-        self.console = Console()
         self.cache_dir = "./cache"
         self.cache_config = os.path.join(self.cache_dir, "cache.json")
         self.adopter = HyperAdopter()
 
-        if not os.path.exists(self.cache_dir):
-            os.mkdir(self.cache_dir)
-
-    def image_to_ansi(self, image: str) -> str:
-        """Convert an image (frame) to ANSI strings
+        os.makedirs(self.cache_dir, exist_ok=True)
 
-        Args:
-            image (str): image path.
+    def extract_audio(self, output_path: str = "audio.wav"):
+        """Extract audio from given video as 16-bit 44.1 kHz stereo PCM WAV.
 
-        Returns:
-            str: ANSI string of the original image given.
-        """
-        return convert_image(image, width=self.terminal_columns, is_unicode=True, is_truecolor=True, is_256color=False)
-
-    def extract_audio(self, output_path: str = "audio.mp3"):
-        """Extract audio from given video.
+        simpleaudio only plays mono or stereo at common sample rates, so surround tracks
+        are downmixed.
 
         Args:
-            output_path (str, optional): Audio output filepath. Defaults to "audio.mp3".
+            output_path (str, optional): Audio output filepath. Defaults to "audio.wav".
         """
-        clip = mp.VideoFileClip(self.video_path)
-        clip.audio.write_audiofile(output_path)
+        subprocess.run([imageio_ffmpeg.get_ffmpeg_exe(), "-nostdin", "-y", "-loglevel", "error",
+                        "-i", self.video_path, "-vn", "-c:a", "pcm_s16le", "-ac", "2", "-ar", "44100",
+                        output_path], check=True)
 
-    def load_cache(self, md5: str) -> tuple[dict, str] | None:
+    def load_cache(self, key: str) -> tuple[Iterator[bytes], str] | None:
         """Load local cache.
 
         Try to load the stored local cache from `self.cache_config` file.
 
         Args:
-            md5 (str): The target video's md5.
+            key (str): The target video's content key.
 
         Returns:
-            tuple[dict, str] | None: A tuple containing the video data and audio path if md5 matches or else will return None.
+            tuple[Iterator[bytes], str] | None: A tuple containing the encoded video frames and audio path if the key matches or else will return None.
         """
         print(f"Trying to load cache from {self.cache_config} ...")
         if not os.path.exists(self.cache_config):
             print("No cache found.")
             return None
-        with open(self.cache_config, "r") as f:
-            caches = json.loads(f.read())
+        caches = orjson.loads(Path(self.cache_config).read_bytes())
         for cache in caches:
-            if cache.get("md5", None) == md5:
-                print(f"Cache {cache.get('md5')} found.")
-                return (pickle.load(open(cache["video"], "rb")), cache["audio_path"])
+            if cache.get("version", None) != CACHE_VERSION:
+                continue
+            if cache.get("key", None) == key:
+                print(f"Cache {cache.get('key')} found.")
+                try:
+                    return (_load_frames(cache["video"]), cache["audio_path"])
+                except (OSError, ValueError) as e:
+                    # converting again replaces the broken entry
+                    print(f"Cache {cache.get('key')} is unusable ({e}).")
+                    return None
         print("No cache found.")
         return None
 
-    def save_cache(self, name: str, vid_path: str, data: dict, audio_path: str):
+    def save_cache(self, name: str, key: str, data: list[str], indices: list[int], audio_path: str):
         """Save processed video and audio to cache.
 
         Args:
             name (str): Video name
-            vid_path (str): Original video path
-            data (dict): Converted ANSI video data
+            key (str): Original video's content key, see `Player._content_key()`
+            data (list[str]): Unique converted ANSI video frames
+            indices (list[int]): Index into `data` of every frame in playback order
             audio_path (str): Extracted audio path
         """
         if os.path.exists(self.cache_config):
-            with open(self.cache_config, "r") as f:
-                caches = json.loads(f.read())
+            caches = orjson.loads(Path(self.cache_config).read_bytes())
         else:
             caches = []
+        # Drop entries that can't be loaded anymore or are replaced by this one, with their files
+        kept = []
+        for cache in caches:
+            if cache.get("version", None) == CACHE_VERSION and cache.get("key", None) != key:
+                kept.append(cache)
+                continue
+            for stale in (cache.get("video"), cache.get("audio_path")):
+                if stale:
+                    Path(stale).unlink(missing_ok=True)
+        caches = kept
         uuid = uuid4()
-        pickle.dump(data, open(f"./cache/{uuid}.pickle", "wb"))
+        _dump_frames(f"./cache/{uuid}.bin", data, indices)
         caches.append({
             "name": name,
-            "video": f"./cache/{uuid}.pickle",
+            "video": f"./cache/{uuid}.bin",
             "audio_path": audio_path,
-            "md5": self.get_md5(vid_path)
+            "key": key,
+            "version": CACHE_VERSION
         })
-        with open(self.cache_config, "w") as f:
-            f.write(json.dumps(caches, indent=2, ensure_ascii=False))
+        Path(self.cache_config).write_bytes(orjson.dumps(caches))
 
-    def convert_to_ansi(self, fps: int = 2) -> list[str]:
-        """Convert given video to ANSI characters.
+    def _decode_frames(self, fps: int, frames: Queue) -> None:
+        """Decode the frames due for output and push them to `frames` .
 
-        Args:
-            fps (int, optional): Frames per second of the output video. Defaults to 2.
+        Meant to run in its own thread. A `None` is pushed once the video is exhausted.
 
-        Returns:
-            list[str]: Converted ANSI characters where each frame is a string stored in the list.
+        Args:
+            fps (int): Frames per second of the output video.
+            frames (Queue): Queue receiving downscaled BGR frames.
         """
-        fps_in = self.video.get(cv2.CAP_PROP_FPS)
-        fps_out = fps
-        index_in = -1
+        stream = self.video.streams.video[0]
+        # FFmpeg decodes on its own threads without holding the GIL
+        stream.thread_type = "AUTO"
+        rate = stream.average_rate or stream.guessed_rate
+        # without a known frame rate there's no telling how sparse keyframes are, decode all frames
+        if rate and rate / fps >= KEYFRAME_MIN_STEP:
+            stream.codec_context.skip_frame = "NONKEY"
+        # timestamps may not start at 0 (e.g. MPEG-TS), while the extracted audio always does
+        start = float((stream.start_time or 0) * stream.time_base)
         index_out = -1
-        result = []
-        frame_loc = os.path.join(self.cache_dir, ".cur-frame.jpg")
-        with Progress() as progress:
-            task = progress.add_task(
-                "Converting to ANSI", total=self.video.get(cv2.CAP_PROP_FRAME_COUNT))
-            while True:
-                success = self.video.grab()
-                if not success:
-                    break
-                index_in += 1
-
-                out_due = int(index_in / fps_in * fps_out)
+        previous = None
+        try:
+            for frame in self.video.decode(stream):
+                # frames without a timestamp can't be placed, the previous one holds over their slot
+                if frame.time is None:
+                    continue
+                out_due = int(max(frame.time - start, 0) * fps)
                 if out_due > index_out:
-                    success, frame = self.video.retrieve()
-                    if not success:
-                        break
+                    image = _downscale(frame.to_ndarray(format="bgr24"),
+                                       self.terminal_columns, self.terminal_lines)
+                    # hold the previous frame over slots with no frame of their own, so the
+                    # new one isn't shown before its time (there's nothing earlier for the first)
+                    while out_due > index_out + 1:
+                        index_out += 1
+                        frames.put(image if previous is None else previous)
                     index_out += 1
-                    cv2.imwrite(frame_loc, frame)
-                    f = self.image_to_ansi(frame_loc)
-                    result.append(f)
-                progress.update(task, advance=1)
-        return result
+                    frames.put(image)
+                    previous = image
+        finally:
+            frames.put(None)
+
+    def convert_to_ansi(self, fps: int = 2, prefetch: int = 32) -> tuple[list[str], list[int]]:
+        """Convert given video to ANSI characters.
 
-    def get_md5(self, vid_path: str) -> str:
-        """Get the md5 value of the given video.
+        Decoding runs in a background thread while worker processes convert the frames,
+        with at most `prefetch` frames held in memory at a time. Frames with exactly the same
+        pixels as an earlier one reuse its conversion, and identical frames are only stored once.
+
+        Args:
+            fps (int, optional): Frames per second of the output video. Defaults to 2.
+            prefetch (int, optional): Maximum number of frames buffered between stages. Defaults to 32.
+
+        Returns:
+            tuple[list[str], list[int]]: The unique frames, each an ANSI string, and the index into them of every frame in playback order.
+        """
+        total = int((self.video.duration or 0) / av.time_base * fps) + 1
+        decoded = Queue(maxsize=prefetch)
+        pending = deque()
+        converted = {}
+        unique = {}
+        frames = []
+        indices = []
+        errors = []
+
+        def decode():
+            try:
+                self._decode_frames(fps, decoded)
+            except Exception as e:
+                errors.append(e)
+
+        def collect():
+            frame = pending.popleft().result()
+            if frame not in unique:
+                unique[frame] = len(frames)
+                frames.append(frame)
+            indices.append(unique[frame])
+            progress.update(task, advance=1)
+
+        # Workers are spawned fresh, forking while the decoder, FFmpeg and rich threads
+        # run could leave them holding a lock that's never released
+        with ProcessPoolExecutor(max_workers=os.cpu_count(), mp_context=get_context("spawn")) as executor, \
+                Progress() as progress:
+            decoder = Thread(target=decode, daemon=True)
+            decoder.start()
+            task = progress.add_task("Converting to ANSI", total=total)
+            while (frame := decoded.get()) is not None:
+                h = blake2b(frame.tobytes(), digest_size=16).digest()
+                if h not in converted:
+                    converted[h] = executor.submit(_frame_to_ansi, frame)
+                pending.append(converted[h])
+                if len(pending) >= prefetch:
+                    collect()
+            while pending:
+                collect()
+        decoder.join()
+        # a failed decode ends the queue early, don't hand back a truncated video
+        if errors:
+            raise errors[0]
+        return (frames, indices)
+
+    def _content_key(self, vid_path: str) -> str:
+        """Get the cache key of the given video.
+
+        The key only identifies cached videos, so a short BLAKE2b digest is enough.
 
         Args:
             vid_path (str): Video path.
 
         Returns:
-            str: The md5 value.
+            str: The BLAKE2b digest of the video content.
         """
+        h = blake2b(digest_size=16)
         with open(vid_path, "rb") as f:
-            vid_content = f.read()
-        return md5(vid_content).hexdigest()
+            while chunk := f.read(1 << 20):
+                h.update(chunk)
+        return h.hexdigest()
+
+    def _prefetch_frames(self, video: Iterable[bytes], frames: Queue) -> None:
+        """Read frames ahead of playback and push them to `frames` .
+
+        Meant to run in its own thread. A `None` is pushed once the video is exhausted.
+
+        Args:
+            video (Iterable[bytes]): Encoded frames to read.
+            frames (Queue): Queue receiving the frames.
+        """
+        try:
+            for frame in video:
+                frames.put(frame)
+        finally:
+            frames.put(None)
 
     def _play(self, fps: int = 5, font_size: int = 13):
         """Plays the video in the terminal.
@@ -167,43 +408,65 @@ class Player(object):
         """
         # Try to load video data from cache first
         # Because converting video to ANSI takes a quite a long time
+        key = self._content_key(self.video_path)
         try:
-            (video, audio_path) = self.load_cache(
-                self.get_md5(self.video_path))
+            (video, audio_path) = self.load_cache(key)
         except TypeError:
             self.adopter.adjust_terminal_font_size(font_size)
             sleep(1)
-            self.terminal_columns = get_terminal_size().columns
+            (self.terminal_columns, self.terminal_lines) = get_terminal_size()
             self.adopter.restore_terminal_font_size()
-            video = self.convert_to_ansi(fps)
-            audio_path = f"./cache/{uuid4()}.mp3"
-            self.extract_audio(audio_path)
+            audio_path = f"./cache/{uuid4()}.wav"
+            # Audio extraction doesn't depend on the frames, so run it alongside the conversion
+            with ThreadPoolExecutor(max_workers=1) as pool:
+                extraction = pool.submit(self.extract_audio, audio_path)
+                (frames, indices) = self.convert_to_ansi(fps)
+                extraction.result()
+            encoded = [frame.encode() for frame in frames]
+            video = (encoded[index] for index in indices)
             print("Converted. Saving cache...")
-            self.save_cache(self.video_name, self.video_path,
-                            video, audio_path)
+            self.save_cache(self.video_name, key,
+                            frames, indices, audio_path)
             print("Cache saved.")
 
         self.adopter.adjust_terminal_font_size(font_size)
 
-        SLEEP_PER_FRAME = 1 / fps
+        NS_PER_FRAME = 10 ** 9 // fps
 
-        with self.console.screen() as screen:
-            start_time = time()
-            delta = 0
-            playsound(audio_path, block=False)
-            for frame in video:
+        # Load the audio up front so starting playback doesn't delay the first frames
+        audio = simpleaudio.WaveObject.from_wave_file(audio_path)
+
+        # Read frames in the background so a slow read doesn't eat into the frame time
+        buffered = Queue(maxsize=4)
+        Thread(target=self._prefetch_frames,
+               args=(video, buffered), daemon=True).start()
+
+        # Frames are already ANSI, so write them straight to the terminal's alternate screen
+        out = sys.stdout.buffer
+        sys.stdout.flush()
+        prev = None
+        playback = None
+        try:
+            out.write(b"\x1b[?1049h\x1b[?25l")
+            playback = audio.play()
+            # end of the current frame's time slot, counted from when the audio started
+            deadline = perf_counter_ns()
+            for frame in iter(buffered.get, None):
+                deadline += NS_PER_FRAME
                 # if the current frame is delayed one frame time or more, skip it
-                if delta >= SLEEP_PER_FRAME:
-                    delta -= SLEEP_PER_FRAME
-                    start_time = time()
+                if perf_counter_ns() >= deadline:
                     continue
-                screen.update(Text.from_ansi(frame))
-                end_time = time()
-                est = SLEEP_PER_FRAME - (end_time - start_time)
-                if est < 0:
-                    delta += abs(est)  # adds up the total delayed time
-                sleep(max(est, 0))
-                start_time = time()
+                # unchanged frames don't need to be redrawn
+                if frame is not prev:
+                    out.write(b"\x1b[H" + frame)
+                    out.flush()
+                    prev = frame
+                sleep(max(deadline - perf_counter_ns(), 0) / 10 ** 9)
+        finally:
+            if playback is not None:
+                playback.stop()
+            out.write(b"\x1b[?25h\x1b[?1049l")
+            out.flush()
 
     def play(self, fps: int = 5, font_size: int = 13):
         """Plays the video in the terminal.